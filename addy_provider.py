@@ -5,57 +5,122 @@ Simple HTTP adapter for sending email via Addy.io-like transactional API.
 
 This implementation POSTs a JSON payload to the configured endpoint with a Bearer API key.
 It embeds local image assets as data URIs into the HTML so attachments aren't required.
+With `ADDY_MULTIPART=true` it instead POSTs multipart/form-data: the HTML references images as
+`cid:<name>` and the raw image files are uploaded as `attachments[]`, avoiding base64 inflation.
 
 Note: confirm the exact Addy API endpoint and field names for production usage. The URL used here
 is a reasonable default placeholder and can be overridden via the `ADDY_API_URL` env var.
 """
 import os
-import base64
+import re
+import mimetypes
+from contextlib import ExitStack
 from pathlib import Path
-from utils import get_requests_session, retry_backoff
+from utils import get_requests_session, list_image_assets, retry_backoff
 import logging
 
+try:
+    # SIMD (AVX2/NEON) base64, same API as the stdlib
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
 _session = get_requests_session(retries=3, backoff_factor=0.5)
 
 
+# read size for streaming base64; a multiple of 3 so chunk encodings concatenate without padding
+_B64_CHUNK = 3 * 1024 * 64
+
+# encoded data URIs keyed by (path, mtime_ns, size) so repeated sends don't re-encode unchanged files
+_DATA_URI_CACHE: dict[tuple, str] = {}
+
+
+def _b64encode_file(path) -> str:
+    # encode chunk by chunk so the raw file bytes are never held in memory alongside the encoded copy
+    out = bytearray()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(_B64_CHUNK)
+            if not chunk:
+                break
+            out += b64encode(chunk)
+    return out.decode('ascii')
+
+
+def _data_uri(img: os.DirEntry) -> str:
+    st = img.stat()
+    key = (os.path.abspath(img.path), st.st_mtime_ns, st.st_size)
+    cached = _DATA_URI_CACHE.get(key)
+    if cached is not None:
+        return cached
+    suffix = img.name.rpartition('.')[2].lower()
+    mime = 'image/jpeg' if suffix in ('jpg', 'jpeg') else f'image/{suffix}'
+    data = _b64encode_file(img)
+    data_uri = f'data:{mime};base64,{data}'
+    _DATA_URI_CACHE[key] = data_uri
+    return data_uri
+
+
 def _embed_images_into_html(html: str, assets_dir: Path | None):
-    if not assets_dir or not assets_dir.exists():
+    if not assets_dir:
         return html
-    assets_dir = Path(assets_dir)
-    for img in assets_dir.iterdir():
-        if img.suffix.lower() in ('.png', '.jpg', '.jpeg', '.gif'):
-            try:
-                b = img.read_bytes()
-                mime = 'image/jpeg' if img.suffix.lower() in ('.jpg', '.jpeg') else f'image/{img.suffix.lstrip('.')}'
-                data = base64.b64encode(b).decode('ascii')
-                data_uri = f'data:{mime};base64,{data}'
-                html = html.replace(f'data/{img.name}', data_uri)
-            except Exception:
-                continue
-    return html
+    mapping = {}
+    for img in list_image_assets(assets_dir):
+        try:
+            mapping[f'data/{img.name}'] = _data_uri(img)
+        except Exception:
+            continue
+    if not mapping:
+        return html
+    # one pass over the HTML instead of one str.replace per image; longest names first so prefixes don't shadow
+    pattern = re.compile('|'.join(re.escape(k) for k in sorted(mapping, key=len, reverse=True)))
+    return pattern.sub(lambda m: mapping[m.group(0)], html)
+
+
+def _cid_images(html: str, assets_dir: Path | None):
+    """
+    Rewrite `data/<name>` references to `cid:<name>` (as email_send does for SMTP) and return
+    (html, [image DirEntry]) for upload as multipart attachments.
+    """
+    images = list_image_assets(assets_dir) if assets_dir else []
+    if not images:
+        return html, []
+    mapping = {f'data/{img.name}': f'cid:{img.name}' for img in images}
+    pattern = re.compile('|'.join(re.escape(k) for k in sorted(mapping, key=len, reverse=True)))
+    return pattern.sub(lambda m: mapping[m.group(0)], html), images
 
 
 @retry_backoff(max_attempts=4, initial_delay=0.5, factor=2.0, exceptions=(Exception,))
-def send_via_addy(api_key: str, email_from: str, email_to: str, subject: str, html: str, assets_dir: Path | None = None, api_url: str | None = None) -> bool:
+def send_via_addy(api_key: str, email_from: str, email_to: str, subject: str, html: str, assets_dir: Path | None = None, api_url: str | None = None, multipart: bool | None = None) -> bool:
     """
     Send email via Addy HTTP API. Returns True on accepted (2xx) response.
-    Retries transient errors.
+    Retries transient errors. `multipart` (default: env ADDY_MULTIPART) uploads images as CID
+    attachments instead of inlining them as base64 data URIs.
     """
     api_url = api_url or os.getenv('ADDY_API_URL', 'https://api.addy.io/v1/messages')
-    headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
-
-    # embed images as data URIs so we don't need multipart uploads
-    html_embedded = _embed_images_into_html(html, assets_dir)
-
-    payload = {
-        'from': email_from,
-        'to': email_to,
-        'subject': subject,
-        'html': html_embedded,
-    }
+    if multipart is None:
+        multipart = os.getenv('ADDY_MULTIPART', '').lower() in ('1', 'true', 'yes')
+    headers = {'Authorization': f'Bearer {api_key}'}
 
     try:
-        r = _session.post(api_url, json=payload, headers=headers, timeout=20)
+        if multipart:
+            html_cid, images = _cid_images(html, assets_dir)
+            data = {'from': email_from, 'to': email_to, 'subject': subject, 'html': html_cid}
+            with ExitStack() as stack:
+                files = [
+                    ('attachments[]', (img.name, stack.enter_context(open(img, 'rb')), mimetypes.guess_type(img.name)[0] or 'application/octet-stream'))
+                    for img in images
+                ]
+                r = _session.post(api_url, data=data, files=files, headers=headers, timeout=20)
+        else:
+            # embed images as data URIs so we don't need multipart uploads
+            payload = {
+                'from': email_from,
+                'to': email_to,
+                'subject': subject,
+                'html': _embed_images_into_html(html, assets_dir),
+            }
+            r = _session.post(api_url, json=payload, headers=headers, timeout=20)
     except Exception:
         logging.exception('Addy request failed (network/DNS)')
         raise
@@ -1,8 +1,19 @@
 import sqlite3
 import json
+from datetime import date, datetime, timedelta
 from pathlib import Path
 from typing import Optional, Dict, Any, List
 
+try:
+    import orjson
+except ImportError:  # optional speedup; fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # optional; without it details are stored as plain JSON
+    zstandard = None
+
 
 DB_SCHEMA = '''
 CREATE TABLE IF NOT EXISTS permits (
@@ -13,43 +24,230 @@ CREATE TABLE IF NOT EXISTS permits (
     lon REAL,
     details_json TEXT,
     thumbnail_path TEXT,
-    scraped_at TEXT
+    scraped_at TEXT,
+    details_codec TEXT
 );
 
 CREATE INDEX IF NOT EXISTS idx_permits_scraped_at ON permits(scraped_at);
+
+-- keyed by normalized address (see geo_imagery.normalize_address); source is the geocoder host
+CREATE TABLE IF NOT EXISTS geocode_cache (
+    address TEXT PRIMARY KEY,
+    lat REAL,
+    lon REAL,
+    source TEXT,
+    ts TEXT
+);
+'''
+
+_UPSERT_SQL = '''
+INSERT INTO permits (permit_number, address, lat, lon, details_json, details_codec, thumbnail_path, scraped_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(permit_number) DO UPDATE SET
+    address=excluded.address,
+    lat=excluded.lat,
+    lon=excluded.lon,
+    details_json=excluded.details_json,
+    details_codec=excluded.details_codec,
+    thumbnail_path=excluded.thumbnail_path,
+    scraped_at=excluded.scraped_at
 '''
 
+_SET_THUMBNAIL_SQL = 'UPDATE permits SET thumbnail_path = ? WHERE permit_number = ?'
+
+_GET_GEOCODE_SQL = 'SELECT lat, lon FROM geocode_cache WHERE address = ?'
+_PUT_GEOCODE_SQL = 'INSERT OR REPLACE INTO geocode_cache (address, lat, lon, source, ts) VALUES (?, ?, ?, ?, ?)'
+
+# columns added after a table first shipped; CREATE TABLE IF NOT EXISTS won't add them to existing DBs
+_MIGRATIONS = [
+    ('geocode_cache', 'source', 'TEXT'),
+    ('permits', 'details_codec', 'TEXT'),
+]
+
+# details_json holds either JSON text (codec 'json', or NULL for rows written before the column existed)
+# or a zstd-compressed JSON blob (codec 'zstd'); page text compresses several-fold
+_ZSTD_LEVEL = 3
+
+def dumps_details(details: Dict[str, Any]) -> str:
+    if orjson is not None:
+        return orjson.dumps(details).decode('utf8')
+    return json.dumps(details, ensure_ascii=False)
+
+
+def loads_details(details_json: str | bytes | None, codec: str | None = None) -> Dict[str, Any]:
+    if not details_json:
+        return {}
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('details are zstd-compressed but the zstandard package is not installed')
+        details_json = zstandard.ZstdDecompressor().decompress(details_json)
+    if orjson is not None:
+        return orjson.loads(details_json)
+    return json.loads(details_json)
+
+
+def encode_details(details: Dict[str, Any], compressor=None) -> tuple:
+    """
+    Return (value, codec) for the details_json/details_codec columns. Pass a reusable
+    zstandard.ZstdCompressor as `compressor` when encoding many rows.
+    """
+    text = dumps_details(details)
+    if zstandard is None:
+        return text, 'json'
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+    return compressor.compress(text.encode('utf8')), 'zstd'
+
+
+# shared connections handed out by DB.get(), keyed by absolute path
+_DB_INSTANCES: Dict[str, 'DB'] = {}
+
 
 class DB:
     def __init__(self, path: str | Path):
         self.path = Path(path)
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(str(self.path))
+        self._schema_ready = False
+        # isolation_level=None: transactions are opened explicitly (see _begin / upsert_permits_many)
+        self.conn = sqlite3.connect(str(self.path), isolation_level=None)
         self.conn.row_factory = sqlite3.Row
+        # Long-lived cursor for writes. sqlite3 keeps a per-connection statement cache, so the
+        # constant SQL strings below are compiled once and only re-bound on later calls;
+        # executemany goes further and binds one prepared statement N times.
+        self._cur = self.conn.cursor()
+        # reused for every row written; like the connection, a DB is used from one thread at a time
+        self._compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL) if zstandard is not None else None
         self._ensure_schema()
 
+    @classmethod
+    def get(cls, path: str | Path) -> 'DB':
+        """
+        Return a shared DB for `path`, opening it on first use. Callers should not close it;
+        it lives for the rest of the process (or until someone calls close()).
+        """
+        if str(path) == ':memory:':
+            return cls(path)
+        key = str(Path(path).resolve())
+        db = _DB_INSTANCES.get(key)
+        if db is None:
+            db = _DB_INSTANCES[key] = cls(path)
+        return db
+
     def _ensure_schema(self):
+        if self._schema_ready:
+            return
         cur = self.conn.cursor()
+        if str(self.path) == ':memory:':
+            # nothing to make durable (tests, scratch runs)
+            cur.execute('PRAGMA journal_mode=MEMORY')
+            cur.execute('PRAGMA synchronous=OFF')
+        else:
+            # WAL + synchronous=NORMAL: commits no longer fsync the database file
+            cur.execute('PRAGMA journal_mode=WAL')
+            cur.execute('PRAGMA synchronous=NORMAL')
+        cur.execute('PRAGMA temp_store=MEMORY')
+        cur.execute('PRAGMA cache_size=-65536')  # 64 MiB page cache
+        cur.execute('PRAGMA mmap_size=268435456')
         cur.executescript(DB_SCHEMA)
+        self._migrate()
         self.conn.commit()
+        self._schema_ready = True
+
+    def _migrate(self):
+        for table, column, decl in _MIGRATIONS:
+            cols = {r['name'] for r in self.conn.execute(f'PRAGMA table_info({table})')}
+            if column not in cols:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Transaction scope, like sqlite3.Connection: commit on success, roll back on error.
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def _begin(self):
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN')
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def _executemany(self, sql: str, params: List[tuple]):
+        """
+        Run `sql` for every row as one unit. Inside a caller's transaction (e.g. `with db:`) the rows join
+        it through a savepoint and committing is left to the caller; otherwise they get their own
+        BEGIN IMMEDIATE ... COMMIT.
+        """
+        if self.conn.in_transaction:
+            self._cur.execute('SAVEPOINT executemany')
+            try:
+                self._cur.executemany(sql, params)
+            except Exception:
+                self._cur.execute('ROLLBACK TO executemany')
+                self._cur.execute('RELEASE executemany')
+                raise
+            self._cur.execute('RELEASE executemany')
+            return
+        self._cur.execute('BEGIN IMMEDIATE')
+        try:
+            self._cur.executemany(sql, params)
+        except Exception:
+            self.rollback()
+            raise
+        self.commit()
 
     def upsert_permit(self, permit_number: str, address: str | None, lat: Optional[float], lon: Optional[float], details: Dict[str, Any], scraped_at: str, thumbnail_path: str | None = None):
+        """
+        Insert or update a single permit. Does not commit; call `commit()` or use the DB as a context manager.
+        """
+        self._begin()
+        details_json, codec = encode_details(details, self._compressor)
+        self._cur.execute(_UPSERT_SQL, (permit_number, address, lat, lon, details_json, codec, thumbnail_path, scraped_at))
+
+    def upsert_permits_many(self, rows: List[tuple]):
+        """
+        Insert or update many permits in a single transaction (the caller's, if one is open).
+        Each row is (permit_number, address, lat, lon, details, scraped_at, thumbnail_path).
+        executemany binds one prepared statement per row, so there is no bound-parameter limit to
+        chunk around as there would be with a multi-row VALUES list.
+        """
+        params = [
+            (permit_number, address, lat, lon, *encode_details(details, self._compressor), thumbnail_path, scraped_at)
+            for permit_number, address, lat, lon, details, scraped_at, thumbnail_path in rows
+        ]
+        if not params:
+            return
+        self._executemany(_UPSERT_SQL, params)
+
+    def upsert_thumbnails_many(self, rows: List[tuple]):
+        """
+        Set thumbnail_path for existing permits in a single transaction (the caller's, if one is open).
+        Each row is (permit_number, thumbnail_path); other columns are left untouched.
+        """
+        params = [(thumbnail_path, permit_number) for permit_number, thumbnail_path in rows]
+        if not params:
+            return
+        self._executemany(_SET_THUMBNAIL_SQL, params)
+
+    def get_cached_geocode(self, address: str) -> Optional[tuple]:
         cur = self.conn.cursor()
-        details_json = json.dumps(details, ensure_ascii=False)
-        cur.execute(
-            '''INSERT INTO permits (permit_number, address, lat, lon, details_json, thumbnail_path, scraped_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?)
-               ON CONFLICT(permit_number) DO UPDATE SET
-                   address=excluded.address,
-                   lat=excluded.lat,
-                   lon=excluded.lon,
-                   details_json=excluded.details_json,
-                   thumbnail_path=excluded.thumbnail_path,
-                   scraped_at=excluded.scraped_at
-            ''',
-            (permit_number, address, lat, lon, details_json, thumbnail_path, scraped_at)
+        cur.execute(_GET_GEOCODE_SQL, (address,))
+        row = cur.fetchone()
+        return (row['lat'], row['lon']) if row else None
+
+    def put_cached_geocode(self, address: str, lat: float, lon: float, source: str | None = None):
+        self._cur.execute(
+            _PUT_GEOCODE_SQL,
+            (address, lat, lon, source, datetime.utcnow().isoformat())
         )
-        self.conn.commit()
 
     def get_recent(self, limit: int = 30) -> List[sqlite3.Row]:
         cur = self.conn.cursor()
@@ -57,18 +255,36 @@ class DB:
         return cur.fetchall()
 
     def get_since(self, since_date: str) -> List[sqlite3.Row]:
+        """
+        Return permits scraped on the calendar day of `since_date` (an ISO date or datetime string).
+        """
+        # scraped_at is stored as ISO-8601, so a half-open string range on it is a day filter
+        # that can use idx_permits_scraped_at (wrapping the column in date() forces a full scan)
+        day = date.fromisoformat(since_date[:10])
+        start = day.isoformat()
+        end = (day + timedelta(days=1)).isoformat()
         cur = self.conn.cursor()
-        cur.execute('SELECT * FROM permits WHERE date(scraped_at) = date(?) ORDER BY scraped_at ASC', (since_date,))
+        cur.execute(
+            '''SELECT permit_number, address, lat, lon, details_json, details_codec, thumbnail_path, scraped_at
+               FROM permits
+               WHERE scraped_at >= ? AND scraped_at < ?
+               ORDER BY scraped_at ASC''',
+            (start, end)
+        )
         return cur.fetchall()
 
     def close(self):
+        for key, db in list(_DB_INSTANCES.items()):
+            if db is self:
+                del _DB_INSTANCES[key]
         self.conn.close()
 
 
 if __name__ == '__main__':
     print('Creating sample DB at ./data/epermits.db')
     db = DB('./data/epermits.db')
-    db.upsert_permit('TEST-0001', '123 Main St, Denver, CO', 39.7392, -104.9903, {'type': 'demo'}, '2025-11-13T20:00:00', None)
+    with db:
+        db.upsert_permit('TEST-0001', '123 Main St, Denver, CO', 39.7392, -104.9903, {'type': 'demo'}, '2025-11-13T20:00:00', None)
     rows = db.get_recent()
     for r in rows:
         print(dict(r))
@@ -6,13 +6,14 @@ Configure SMTP via environment variables (see config.example.env).
 This module also supports programmatic and CLI overrides for one-off tests.
 """
 import os
+import atexit
 import smtplib
 from email.message import EmailMessage
 from email.utils import make_msgid
 from pathlib import Path
-from dotenv import load_dotenv
+from utils import load_env_once, list_image_assets
 
-load_dotenv()
+load_env_once()
 
 SMTP_HOST = os.getenv('SMTP_HOST')
 SMTP_PORT = int(os.getenv('SMTP_PORT') or 587)
@@ -22,6 +23,67 @@ EMAIL_FROM = os.getenv('EMAIL_FROM')
 EMAIL_TO = os.getenv('EMAIL_TO')
 
 
+class SmtpPool:
+    """
+    Keeps one authenticated SMTP connection open across sends so repeated calls to `send_report`
+    skip the TCP/TLS/AUTH handshake. The connection is reopened when the settings change or the
+    server has dropped it.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._key = None
+
+    def _open(self, host, port, user, password):
+        # SSL on 465, otherwise STARTTLS on the given port
+        s = smtplib.SMTP_SSL(host, port) if port == 465 else smtplib.SMTP(host, port)
+        try:
+            if port != 465:
+                s.ehlo()
+                s.starttls()
+                s.ehlo()
+            if user and password:
+                s.login(user, password)
+        except Exception:
+            s.close()
+            raise
+        return s
+
+    def _connection(self, host, port, user, password):
+        key = (host, port, user, password)
+        if self._conn is not None and self._key == key:
+            try:
+                if self._conn.noop()[0] == 250:
+                    return self._conn
+            except (smtplib.SMTPException, OSError):
+                pass
+        self.close()
+        self._conn = self._open(host, port, user, password)
+        self._key = key
+        return self._conn
+
+    def send_message(self, msg, host, port, user=None, password=None):
+        try:
+            self._connection(host, port, user, password).send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # dropped between the liveness check and the send; retry once on a fresh connection
+            self.close()
+            self._connection(host, port, user, password).send_message(msg)
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except Exception:
+                pass
+        self._conn = None
+        self._key = None
+
+
+smtp_pool = SmtpPool()
+atexit.register(smtp_pool.close)
+
+
 def send_report(html_path: Path, assets_dir: Path | None = None, subject: str | None = None,
                 smtp_host: str | None = None, smtp_port: int | None = None,
                 smtp_user: str | None = None, smtp_pass: str | None = None,
@@ -50,36 +112,22 @@ def send_report(html_path: Path, assets_dir: Path | None = None, subject: str |
 
     # Prepare inline image attachments and map filenames -> CIDs
     cid_map = {}
-    if assets_dir and assets_dir.exists():
-        for img in assets_dir.iterdir():
-            if img.suffix.lower() in ('.png', '.jpg', '.jpeg', '.gif'):
-                cid = make_msgid(domain='epermits')
-                with open(img, 'rb') as fh:
-                    content = fh.read()
-                maintype = 'image'
-                subtype = img.suffix.lstrip('.').lower()
-                msg.add_attachment(content, maintype=maintype, subtype=subtype, filename=img.name, headers={'Content-ID': f'<{cid.strip("<>")}>', 'Content-Disposition': 'inline'})
-                cid_map[img.name] = cid.strip('<>')
-                html = html.replace(f'data/{img.name}', f'cid:{cid_map[img.name]}')
+    if assets_dir:
+        for img in list_image_assets(assets_dir):
+            cid = make_msgid(domain='epermits')
+            with open(img, 'rb') as fh:
+                content = fh.read()
+            maintype = 'image'
+            subtype = img.name.rpartition('.')[2].lower()
+            msg.add_attachment(content, maintype=maintype, subtype=subtype, filename=img.name, headers={'Content-ID': f'<{cid.strip("<>")}>', 'Content-Disposition': 'inline'})
+            cid_map[img.name] = cid.strip('<>')
+            html = html.replace(f'data/{img.name}', f'cid:{cid_map[img.name]}')
 
     # Add HTML part
     msg.add_alternative(html, subtype='html')
 
-    # Choose transport: SSL on 465, otherwise STARTTLS on given port
     try:
-        if _smtp_port == 465:
-            with smtplib.SMTP_SSL(_smtp_host, _smtp_port) as s:
-                if _smtp_user and _smtp_pass:
-                    s.login(_smtp_user, _smtp_pass)
-                s.send_message(msg)
-        else:
-            with smtplib.SMTP(_smtp_host, _smtp_port) as s:
-                s.ehlo()
-                s.starttls()
-                s.ehlo()
-                if _smtp_user and _smtp_pass:
-                    s.login(_smtp_user, _smtp_pass)
-                s.send_message(msg)
+        smtp_pool.send_message(msg, _smtp_host, _smtp_port, _smtp_user, _smtp_pass)
         print('Email sent to', _to)
     except Exception as e:
         print('Failed to send email:', e)
@@ -8,11 +8,11 @@ and hover details. It writes the HTML to data/report-YYYY-MM-DD.html
 import os
 from datetime import datetime, timedelta
 from pathlib import Path
-from dotenv import load_dotenv
 from jinja2 import Environment, FileSystemLoader
-from db import DB
+from db import DB, loads_details
+from utils import load_env_once, link_or_copy
 
-load_dotenv()
+load_env_once()
 
 DATA_DIR = Path(os.getenv('DATA_DIR', './data'))
 DB_PATH = DATA_DIR / 'epermits.db'
@@ -21,47 +21,52 @@ OUT_DIR = DATA_DIR / 'reports'
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def render_report(for_date: datetime):
-    db = DB(DB_PATH)
-    rows = db.get_since(for_date.isoformat())
-    records = []
+def iter_records(rows, assets_dir: Path | None = None):
+    """
+    Yield template-ready dicts for DB rows: `details` parsed from `details_json`, and when `assets_dir`
+    is given, thumbnails copied there with `thumbnail_path` pointing at the copy.
+    """
     for r in rows:
         rec = dict(r)
-        # details JSON -> dict
+        # details JSON -> dict; the raw columns aren't needed by the template once parsed
         try:
-            import json
-            rec['details'] = json.loads(rec['details_json']) if rec['details_json'] else {}
+            rec['details'] = loads_details(rec.pop('details_json', None), rec.pop('details_codec', None))
         except Exception:
             rec['details'] = {}
-        records.append(rec)
+        if assets_dir is not None and rec.get('thumbnail_path'):
+            src = Path(rec['thumbnail_path'])
+            if src.exists():
+                dst = assets_dir / src.name
+                try:
+                    link_or_copy(src, dst)
+                    # update path to be referenced relative to report file
+                    rec['thumbnail_path'] = str(dst)
+                except Exception:
+                    pass
+        yield rec
+
+
+def render_report(for_date: datetime):
+    db = DB.get(DB_PATH)
+    rows = db.get_since(for_date.isoformat())
     env = Environment(loader=FileSystemLoader(str(TEMPLATES_DIR)))
     template = env.get_template('report.html')
     outname = OUT_DIR / f'report-{for_date.date().isoformat()}.html'
     # copy thumbnails into report folder (so HTML can be sent standalone), unless SKIP_THUMBS
     skip_thumbs = os.getenv('SKIP_THUMBS', '').lower() in ('1', 'true', 'yes')
     assets_dir = OUT_DIR / 'data'
-    if not skip_thumbs:
-        assets_dir.mkdir(parents=True, exist_ok=True)
-        for r in records:
-            if r.get('thumbnail_path'):
-                src = Path(r['thumbnail_path'])
-                if src.exists():
-                    dst = assets_dir / src.name
-                    try:
-                        from shutil import copyfile
-                        copyfile(src, dst)
-                        # update path to be referenced relative to report file
-                        r['thumbnail_path'] = str(dst)
-                    except Exception:
-                        pass
-    else:
-        # ensure assets dir exists but leave empty
-        assets_dir.mkdir(parents=True, exist_ok=True)
+    # ensure assets dir exists (left empty when SKIP_THUMBS)
+    assets_dir.mkdir(parents=True, exist_ok=True)
+    # the template walks records twice (cards, then the JSON blob for the map) and needs its length,
+    # so the generator is materialised once here
+    records = list(iter_records(rows, None if skip_thumbs else assets_dir))
 
-    html = template.render(records=records, title=f'ePermits updates for {for_date.date().isoformat()}')
-    outname.write_text(html, encoding='utf8')
+    # stream the render straight to disk rather than building the whole page as one string
+    stream = template.stream(records=records, title=f'ePermits updates for {for_date.date().isoformat()}')
+    stream.enable_buffering(size=16)
+    with open(outname, 'w', encoding='utf8', buffering=1 << 20) as fh:
+        stream.dump(fh)
     print('Wrote', outname)
-    db.close()
     return outname
 
 
@@ -5,25 +5,68 @@ Shared geocoding and imagery helpers used by the scraper and thumbnail generator
 This module avoids importing Playwright so it can be used in lightweight environments.
 """
 import os
+import re
 import math
+import asyncio
+import shutil
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from io import BytesIO
 from PIL import Image
-from utils import get_requests_session, retry_backoff
+from utils import AsyncRateLimiter, async_retry_backoff, get_requests_session, get_async_client, is_retryable_error, link_or_copy, load_env_once, retry_backoff
+
+# settings below are read at import time, so make sure .env has been loaded first
+load_env_once()
 
 _session = get_requests_session()
 
 GEOCODER_URL = os.getenv('GEOCODER_URL', 'https://nominatim.openstreetmap.org/search')
 GEOCODER_EMAIL = os.getenv('GEOCODER_EMAIL', '')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+ESRI_TILE_URL = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile'
+DATA_DIR = Path(os.getenv('DATA_DIR', './data'))
+# Street View images by rounded location, shared across permits (Google bills per request)
+STREETVIEW_CACHE_DIR = DATA_DIR / 'thumbs_cache'
+# minimum spacing between geocoder requests from the async path (Nominatim allows 1/s)
+GEOCODER_MIN_INTERVAL = float(os.getenv('GEOCODER_MIN_INTERVAL', '1.0'))
+
+_geocode_limiter = AsyncRateLimiter(GEOCODER_MIN_INTERVAL)
+# normalized address -> task resolving to (lat, lon) for the async path; holding the task rather than the
+# result lets concurrent callers for the same address share one in-flight lookup
+_geocode_memo: dict[str, asyncio.Task] = {}
+
+
+def normalize_address(address: str) -> str:
+    """
+    Canonical form used as a cache key: lowercase, punctuation dropped, whitespace collapsed.
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', address.lower()).split())
+
+
+def geocode_address(address: str, session=None):
+    """
+    Return (lat, lon) for `address`, or (None, None) if it isn't found or the geocoder keeps failing.
+    """
+    try:
+        return _geocode_lookup(address, session)
+    except Exception as e:
+        # out of retries (or a non-retryable error): report a miss so the permit is still stored
+        logging.warning('Geocoding %r failed: %s', address, e)
+        return None, None
 
 
-@retry_backoff(max_attempts=4, initial_delay=0.5, factor=2.0, exceptions=(Exception,))
-def geocode_address(address: str):
+# in-process memo on top of the retrying lookup; exceptions aren't cached, so failed calls retry next time
+@functools.lru_cache(maxsize=4096)
+@retry_backoff(max_attempts=4, initial_delay=0.5, factor=2.0, exceptions=(Exception,), retry_on=is_retryable_error)
+def _geocode_lookup(address: str, session=None):
     params = {'q': address, 'format': 'json', 'limit': 1}
     if GEOCODER_EMAIL:
         params['email'] = GEOCODER_EMAIL
-    resp = _session.get(GEOCODER_URL, params=params, timeout=15)
+    resp = (session or _session).get(GEOCODER_URL, params=params, timeout=15)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        resp.raise_for_status()  # transient: retried, and not memoized as a miss
     if resp.status_code == 200:
         j = resp.json()
         if j:
@@ -31,6 +74,52 @@ def geocode_address(address: str):
     return None, None
 
 
+async def geocode_address_async(address: str):
+    """
+    Async variant of `geocode_address`. Requests are spaced by the module rate limiter instead of a
+    blocking sleep, and results are memoized per normalized address for the life of the process;
+    concurrent calls for the same address await a single request. Rate-limit (429) and server errors
+    are retried with jittered backoff; other 4xx, or running out of retries, give (None, None) so the
+    caller can still store the permit. Failures aren't memoized.
+    """
+    key = normalize_address(address)
+    task = _geocode_memo.get(key)
+    if task is None or task.cancelled():
+        # cancelled: its event loop was shut down mid-lookup (e.g. an earlier asyncio.run)
+        task = _geocode_memo[key] = asyncio.ensure_future(_geocode_lookup_async(address))
+    try:
+        # shield: one caller being cancelled must not cancel the lookup the others are waiting on
+        return await asyncio.shield(task)
+    except Exception as e:
+        if _geocode_memo.get(key) is task:
+            del _geocode_memo[key]
+        logging.warning('Geocoding %r failed: %s', address, e)
+        return None, None
+
+
+async def _geocode_lookup_async(address: str):
+    params = {'q': address, 'format': 'json', 'limit': 1}
+    if GEOCODER_EMAIL:
+        params['email'] = GEOCODER_EMAIL
+    resp = await _geocode_request(params)
+    if resp.status_code == 200:
+        j = resp.json()
+        if j:
+            return float(j[0]['lat']), float(j[0]['lon'])
+    return None, None
+
+
+@async_retry_backoff(max_attempts=4, initial_delay=1.0, factor=2.0, exceptions=(Exception,), retry_on=is_retryable_error)
+async def _geocode_request(params):
+    # each attempt takes its own limiter slot, so retries stay within the geocoder's rate limit
+    await _geocode_limiter.wait()
+    resp = await get_async_client().get(GEOCODER_URL, params=params, timeout=15)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        resp.raise_for_status()
+    return resp
+
+
+@functools.lru_cache(maxsize=1024)
 def _deg2num(lat_deg, lon_deg, zoom):
     lat_rad = math.radians(lat_deg)
     n = 2.0 ** zoom
@@ -39,35 +128,45 @@ def _deg2num(lat_deg, lon_deg, zoom):
     return xtile, ytile
 
 
-def fetch_satellite_thumbnail(lat, lon, outpath: Path, size=(400, 300), zoom=18, tiles=3, tilesize=256):
+def _tile_urls(lat, lon, zoom, tiles):
     """
-    Build a satellite thumbnail by downloading `tiles x tiles` tiles from Esri World Imagery and stitching them.
+    Return [(dx, dy, url)] for the `tiles x tiles` Esri World Imagery tiles centred on lat/lon.
     """
-    outpath = Path(outpath)
-    headers = {'User-Agent': 'epermits-scraper/1.0 (+https://example.com)'}
-
     center_x, center_y = _deg2num(lat, lon, zoom)
     half = tiles // 2
+    offsets = range(-half, half + 1)
+    prefix = f'{ESRI_TILE_URL}/{zoom}'
+    return [(dx, dy, f'{prefix}/{center_y + dy}/{center_x + dx}') for dx in offsets for dy in offsets]
+
+
+def _stitch_tiles(results, outpath: Path, size, tiles, tilesize):
+    """
+    Paste downloaded `(dx, dy, content)` tiles onto one canvas, crop the centre to `size` and save as JPEG.
+    Tiles whose content is None (failed downloads) are filled grey.
+    """
+    half = tiles // 2
     canvas_size = tiles * tilesize
     canvas = Image.new('RGB', (canvas_size, canvas_size))
 
-    for dx in range(-half, half + 1):
-        for dy in range(-half, half + 1):
-            tx = center_x + dx
-            ty = center_y + dy
-            url = f'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{zoom}/{ty}/{tx}'
+    placeholder = None
+    for dx, dy, content in results:
+        tile_img = None
+        if content is not None:
             try:
-                r = _session.get(url, timeout=10)
-                if r.status_code == 200:
-                    tile_img = Image.open(BytesIO(r.content)).convert('RGB')
-                else:
-                    tile_img = Image.new('RGB', (tilesize, tilesize), (200, 200, 200))
+                tile_img = Image.open(BytesIO(content))
+                # Esri tiles are RGB JPEGs already; only convert the odd PNG/palette tile
+                if tile_img.mode != 'RGB':
+                    tile_img = tile_img.convert('RGB')
             except Exception:
-                tile_img = Image.new('RGB', (tilesize, tilesize), (200, 200, 200))
+                tile_img = None
+        if tile_img is None:
+            if placeholder is None:
+                placeholder = Image.new('RGB', (tilesize, tilesize), (200, 200, 200))
+            tile_img = placeholder
 
-            px = (dx + half) * tilesize
-            py = (dy + half) * tilesize
-            canvas.paste(tile_img, (px, py))
+        px = (dx + half) * tilesize
+        py = (dy + half) * tilesize
+        canvas.paste(tile_img, (px, py))
 
     cx = canvas.width // 2
     cy = canvas.height // 2
@@ -76,27 +175,137 @@ def fetch_satellite_thumbnail(lat, lon, outpath: Path, size=(400, 300), zoom=18,
     top = max(0, cy - h // 2)
     cropped = canvas.crop((left, top, left + w, top + h))
     outpath.parent.mkdir(parents=True, exist_ok=True)
-    cropped.save(outpath, format='JPEG', quality=85)
+    # may be hardlinked to a cached Street View image or a report asset; replace it rather than truncate it
+    outpath.unlink(missing_ok=True)
+    # 4:2:0 chroma subsampling plus optimized Huffman tables keep thumbnails small for email embedding
+    cropped.save(outpath, format='JPEG', quality=80, subsampling='4:2:0', optimize=True)
     return str(outpath)
 
 
-def fetch_streetview_thumbnail(lat, lon, outpath: Path, size=(400, 300)):
+def fetch_satellite_thumbnail(lat, lon, outpath: Path, size=(400, 300), zoom=18, tiles=3, tilesize=256, session=None):
+    """
+    Build a satellite thumbnail by downloading `tiles x tiles` tiles from Esri World Imagery and stitching them.
+    `session` defaults to the module's pooled requests session.
+    """
+    outpath = Path(outpath)
+    session = session or _session
+    tile_urls = _tile_urls(lat, lon, zoom, tiles)
+
+    def fetch_tile(job):
+        dx, dy, url = job
+        try:
+            r = session.get(url, timeout=10)
+            if r.status_code == 200:
+                return dx, dy, r.content
+        except Exception:
+            pass
+        return dx, dy, None
+
+    # tiles are fetched concurrently over the session's keep-alive pool; decoding and stitching stay on this thread
+    with ThreadPoolExecutor(max_workers=len(tile_urls)) as pool:
+        results = list(pool.map(fetch_tile, tile_urls))
+    return _stitch_tiles(results, outpath, size, tiles, tilesize)
+
+
+async def fetch_satellite_thumbnail_async(lat, lon, outpath: Path, size=(400, 300), zoom=18, tiles=3, tilesize=256):
+    """
+    Async variant of `fetch_satellite_thumbnail` for callers already running an event loop.
+    All tile GETs are in flight at once over the shared HTTP/2 client.
+    """
+    outpath = Path(outpath)
+    client = get_async_client()
+
+    async def fetch_tile(job):
+        dx, dy, url = job
+        try:
+            r = await client.get(url, timeout=10)
+            if r.status_code == 200:
+                return dx, dy, r.content
+        except Exception:
+            pass
+        return dx, dy, None
+
+    results = await asyncio.gather(*[fetch_tile(job) for job in _tile_urls(lat, lon, zoom, tiles)])
+    # JPEG decode/encode is CPU work; keep it off the event loop
+    return await asyncio.to_thread(_stitch_tiles, results, outpath, size, tiles, tilesize)
+
+
+def _streetview_cache_path(lat, lon, size) -> Path:
+    # 5 decimals is ~1 m, so permits at the same address map to one cached image
+    return STREETVIEW_CACHE_DIR / f'{round(lat, 5)}_{round(lon, 5)}_{size[0]}x{size[1]}_sv.jpg'
+
+
+def _streetview_from_cache(cached: Path, outpath: Path):
+    if not cached.exists():
+        return None
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    return str(link_or_copy(cached, outpath))
+
+
+def _streetview_to_cache(outpath: Path, cached: Path):
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(outpath, cached)
+    except OSError:
+        pass  # cache is best effort; the per-permit thumbnail is already written
+
+
+def fetch_streetview_thumbnail(lat, lon, outpath: Path, size=(400, 300), session=None):
     """
     Try Google Street View if API key present; otherwise fall back to satellite thumbnail.
+    `session` defaults to the module's pooled requests session. Street View images are cached
+    under STREETVIEW_CACHE_DIR and linked into place for later permits at the same location.
     """
     outpath = Path(outpath)
+    session = session or _session
     if GOOGLE_API_KEY:
+        cached = _streetview_cache_path(lat, lon, size)
+        hit = _streetview_from_cache(cached, outpath)
+        if hit:
+            return hit
         try:
             url = 'https://maps.googleapis.com/maps/api/streetview'
             params = {'size': f'{size[0]}x{size[1]}', 'location': f'{lat},{lon}', 'key': GOOGLE_API_KEY}
-            r = _session.get(url, params=params, stream=True, timeout=20)
+            r = session.get(url, params=params, stream=True, timeout=20)
             if r.status_code == 200:
                 outpath.parent.mkdir(parents=True, exist_ok=True)
+                outpath.unlink(missing_ok=True)  # may be hardlinked into the cache
+                # copy straight from the urllib3 stream in 64 KiB reads instead of a 1 KiB Python loop
+                r.raw.decode_content = True
                 with open(outpath, 'wb') as fh:
-                    for chunk in r.iter_content(1024):
-                        fh.write(chunk)
+                    shutil.copyfileobj(r.raw, fh, length=1 << 16)
+                _streetview_to_cache(outpath, cached)
                 return str(outpath)
         except Exception:
             pass
     # fallback
-    return fetch_satellite_thumbnail(lat, lon, outpath, size=size)
+    return fetch_satellite_thumbnail(lat, lon, outpath, size=size, session=session)
+
+
+async def fetch_streetview_thumbnail_async(lat, lon, outpath: Path, size=(400, 300)):
+    """
+    Async variant of `fetch_streetview_thumbnail`; falls back to `fetch_satellite_thumbnail_async`.
+    """
+    outpath = Path(outpath)
+    if GOOGLE_API_KEY:
+        cached = _streetview_cache_path(lat, lon, size)
+        hit = _streetview_from_cache(cached, outpath)
+        if hit:
+            return hit
+        try:
+            url = 'https://maps.googleapis.com/maps/api/streetview'
+            params = {'size': f'{size[0]}x{size[1]}', 'location': f'{lat},{lon}', 'key': GOOGLE_API_KEY}
+            client = get_async_client()
+            async with client.stream('GET', url, params=params, timeout=20) as r:
+                if r.status_code == 200:
+                    outpath.parent.mkdir(parents=True, exist_ok=True)
+                    outpath.unlink(missing_ok=True)  # may be hardlinked into the cache
+                    with open(outpath, 'wb') as fh:
+                        async for chunk in r.aiter_bytes(1 << 16):
+                            fh.write(chunk)
+                    _streetview_to_cache(outpath, cached)
+                    return str(outpath)
+        except Exception:
+            pass
+    # fallback
+    return await fetch_satellite_thumbnail_async(lat, lon, outpath, size=size)
@@ -7,3 +7,4 @@ export PLAYWRIGHT_SKIP_BROWSER_DOWNLOAD=1
 
 # Run tests directly to avoid system pytest plugins interfering in this environment.
 python3 tests/test_db.py
+python3 tests/test_utils.py
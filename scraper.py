@@ -7,21 +7,25 @@ This script uses Playwright to log into the Denver ePermits site and search for
 It scrapes permit list results, visits each permit page, extracts key details, attempts to geocode addresses
 and stores records in a central sqlite DB (see `db.py`).
 
+Permit detail pages are scraped concurrently on a small pool of browser pages (SCRAPE_CONCURRENCY, default 5);
+login, search and pagination stay serial.
+
 Configure via .env (see config.example.env).
 """
 import os
-import time
+import re
 import json
+import asyncio
 from datetime import datetime
 from pathlib import Path
-import requests
-from geo_imagery import geocode_address, fetch_streetview_thumbnail, fetch_satellite_thumbnail
-from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
+from urllib.parse import urljoin, urlparse
+from geo_imagery import geocode_address_async, normalize_address, fetch_streetview_thumbnail_async, fetch_satellite_thumbnail_async
+from playwright.async_api import async_playwright
 
 from db import DB
+from utils import close_async_client, load_env_once
 
-load_dotenv()
+load_env_once()
 
 EP_USER = os.getenv('EPERMITS_USERNAME')
 EP_PASS = os.getenv('EPERMITS_PASSWORD')
@@ -29,138 +33,166 @@ DATA_DIR = Path(os.getenv('DATA_DIR', './data'))
 DB_PATH = DATA_DIR / 'epermits.db'
 GEOCODER_URL = os.getenv('GEOCODER_URL', 'https://nominatim.openstreetmap.org/search')
 GEOCODER_EMAIL = os.getenv('GEOCODER_EMAIL', '')
+# recorded alongside cached geocodes so results from different providers can be told apart
+GEOCODER_SOURCE = urlparse(GEOCODER_URL).hostname
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# number of permit detail pages loaded in parallel
+SCRAPE_CONCURRENCY = int(os.getenv('SCRAPE_CONCURRENCY', '5'))
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+# detail-page fields -> candidate selectors, first non-empty match wins; tune these if the layout changes
+FIELD_SELECTORS = {
+    'permit_number': ['#ctl00_PlaceHolderMain_lblCapID', 'span.permit-number'],
+    'address': ['#ctl00_PlaceHolderMain_lblAddress', 'div.address'],
+    'owner': ['#ctl00_PlaceHolderMain_lblOwner'],
+}
+# Reads every field (trimmed in JS), the free-text body and the page HTML in one page.evaluate call:
+# one CDP round trip per permit instead of one per field. `_html` is for the lat/lon search only.
+# raw_text is kept for reference in the DB, so it is capped at RAW_TEXT_MAX_CHARS.
+RAW_TEXT_MAX_CHARS = 32 * 1024
+JS_EXTRACT = """([selectors, maxText]) => {
+    const out = {};
+    for (const k in selectors) {
+        out[k] = null;
+        for (const s of selectors[k]) {
+            const el = document.querySelector(s);
+            const t = el && el.innerText.trim();
+            if (t) { out[k] = t; break; }
+        }
+    }
+    out.raw_text = document.body ? document.body.innerText.slice(0, maxText) : '';
+    out._html = document.documentElement.outerHTML;
+    return out;
+}"""
+
+# login form candidates, most specific first (the recording used #username / #passwordRequired / SIGN IN)
+LOGIN_USER_SELECTORS = ('#username', 'input[name="username"]', 'input[type="email"]')
+LOGIN_PASS_SELECTORS = ('#passwordRequired', 'input[name="password"]', 'input[type="password"]')
+LOGIN_SUBMIT_SELECTORS = ('button[type="submit"]', 'text=SIGN IN', 'text="Sign in"', 'text="Sign In"')
+
+# results grid on the search page, and the element that marks a permit detail page as rendered
+RESULTS_GRID = '#ctl00_PlaceHolderMain_dgvPermitList_gdvPermitList'
+DETAIL_READY = ', '.join(FIELD_SELECTORS['permit_number'])
+_FIRST_ROW_TEXT_JS = "(sel) => { const a = document.querySelector(sel); return a ? a.innerText : null; }"
+_ANCHORS_JS = "els => els.map(a => ({text: a.innerText, href: a.getAttribute('href')}))"
+_ROW_CHANGED_JS = "([sel, prev]) => { const a = document.querySelector(sel); return !!a && a.innerText !== prev; }"
+
+# requests the scraper never needs: extraction reads DOM text only (JS stays enabled; the grid may depend on it)
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'font', 'media', 'stylesheet'})
+BLOCKED_URL_PARTS = ('google-analytics', 'doubleclick', 'googletagmanager', 'hotjar')
+
+# "lat, lon" pair as it appears in map links/scripts on permit pages
+_LATLON_RE = re.compile(r'([-+]?\d{1,3}\.\d{4,}),\s*([-+]?\d{1,3}\.\d{4,})')
+
+# permits are written to the DB in batches of this many rows (one transaction per batch), so a
+# crash mid-run loses at most one batch while commits stay amortised
+UPSERT_BATCH_SIZE = 200
+
 
 # geocoding and thumbnail functions moved to geo_imagery.py and imported above
 
 
-def parse_permit_detail(page):
-    # Try to extract common fields; these selectors are based on the Playwright recording and may need tuning.
-    def safe_text(sel):
-        try:
-            el = page.query_selector(sel)
-            return el.inner_text().strip() if el else None
-        except Exception:
-            return None
-
-    data = {}
-    # Permit number
-    data['permit_number'] = safe_text('#ctl00_PlaceHolderMain_lblCapID') or safe_text('span.permit-number') or None
-    # Address
-    data['address'] = safe_text('#ctl00_PlaceHolderMain_lblAddress') or safe_text('div.address') or None
-    # Owner
-    data['owner'] = safe_text('#ctl00_PlaceHolderMain_lblOwner') or None
-    # More free text fallback: capture main content text
+async def geocode_cached(db, address):
+    """
+    Geocode `address`, consulting the DB's geocode_cache first so addresses seen in earlier runs
+    cost no network round trip. The cache is keyed by the normalized address, so spelling variants
+    ("123 Main St." / "123 main st") share an entry. Network lookups are rate limited inside
+    geocode_address_async, so concurrent workers queue there rather than sleeping.
+    """
+    key = normalize_address(address)
+    hit = db.get_cached_geocode(key)
+    if hit:
+        return hit
+    lat, lon = await geocode_address_async(address)
+    if lat is not None and lon is not None:
+        db.put_cached_geocode(key, lat, lon, GEOCODER_SOURCE)
+    return lat, lon
+
+
+async def block_unneeded_requests(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(part in request.url for part in BLOCKED_URL_PARTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def parse_permit_detail(page):
+    # Extract common fields; selectors (FIELD_SELECTORS) are based on the Playwright recording and may need tuning.
+    # Callers pop `_html` before storing.
     try:
-        body = page.inner_text('body')
-        data['raw_text'] = body
+        return await page.evaluate(JS_EXTRACT, [FIELD_SELECTORS, RAW_TEXT_MAX_CHARS])
     except Exception:
-        data['raw_text'] = ''
-    return data
+        return {**dict.fromkeys(FIELD_SELECTORS), 'raw_text': '', '_html': ''}
 
 
-def run_scrape(max_items=200):
-    db = DB(DB_PATH)
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context()
-        page = context.new_page()
+async def _first_present(scope, selectors):
+    """
+    Return the first of `selectors` matching anything in `scope` (a page or frame), or None.
+    locator.count() doesn't wait, so probing a missing selector costs one DOM query, not a timeout.
+    """
+    for sel in selectors:
+        if await scope.locator(sel).count():
+            return sel
+    return None
 
-        # Login flow based on recording
-        page.goto('https://aca-prod.accela.com/DENVER/Login.aspx')
-        # Try multiple login strategies: top-level selectors, common alternatives, then any iframes.
-        logged_in = False
 
-        # Strategy A: top-level common selectors
-        try:
-            for u_sel in ['#username', 'input[name="username"]', 'input[type="email"]']:
-                try:
-                    page.fill(u_sel, EP_USER)
-                    break
-                except Exception:
-                    continue
-            for p_sel in ['#passwordRequired', 'input[name="password"]', 'input[type="password"]']:
-                try:
-                    page.fill(p_sel, EP_PASS)
-                    break
-                except Exception:
-                    continue
-            # try several possible submit/button selectors
-            for btn in ['button[type="submit"]', 'text=SIGN IN', 'text="Sign in"', 'text="Sign In"']:
-                try:
-                    page.click(btn)
-                    page.wait_for_load_state('networkidle', timeout=15000)
-                    logged_in = True
-                    break
-                except Exception:
-                    continue
-        except Exception:
-            pass
+async def login(page) -> bool:
+    # the form can render just after DOMContentLoaded, so give the top-level page a short head start
+    try:
+        await page.locator(', '.join(LOGIN_USER_SELECTORS)).first.wait_for(state='visible', timeout=3000)
+    except Exception:
+        pass  # not at top level; it may be inside an iframe
+    # page.frames starts with the main frame, so top-level forms win over iframes
+    for frame in page.frames:
+        user_sel = await _first_present(frame, LOGIN_USER_SELECTORS)
+        if user_sel:
+            break
+    else:
+        return False
+    pass_sel = await _first_present(frame, LOGIN_PASS_SELECTORS)
+    submit_sel = await _first_present(frame, LOGIN_SUBMIT_SELECTORS)
+    if not (pass_sel and submit_sel):
+        return False
+    try:
+        await frame.locator(user_sel).first.fill(EP_USER, timeout=3000)
+        await frame.locator(pass_sel).first.fill(EP_PASS, timeout=3000)
+        await frame.locator(submit_sel).first.click(timeout=3000)
+        await page.wait_for_load_state('domcontentloaded', timeout=15000)
+    except Exception:
+        return False
+    return True
 
-        # Strategy B: try alternate top-level flows (explicit fills)
-        if not logged_in:
-            try:
-                page.fill('#username', EP_USER)
-                page.fill('#passwordRequired', EP_PASS)
-                page.click('text=SIGN IN')
-                page.wait_for_load_state('networkidle', timeout=15000)
-                logged_in = True
-            except Exception:
-                pass
 
-        # Strategy C: look for login forms inside iframes
-        if not logged_in:
-            try:
-                for frame in page.frames:
-                    try:
-                        # try user/pass in this frame
-                        found_user = None
-                        for u_sel in ['#username', 'input[name="username"]', 'input[type="email"]']:
-                            if frame.query_selector(u_sel):
-                                frame.fill(u_sel, EP_USER)
-                                found_user = u_sel
-                                break
-                        found_pass = None
-                        for p_sel in ['#passwordRequired', 'input[name="password"]', 'input[type="password"]']:
-                            if frame.query_selector(p_sel):
-                                frame.fill(p_sel, EP_PASS)
-                                found_pass = p_sel
-                                break
-                        if not found_user and not found_pass:
-                            continue
-                        # try clicking submit within the frame
-                        for btn in ['button[type="submit"]', 'text=SIGN IN', 'text="Sign in"', 'text="Sign In"']:
-                            try:
-                                if frame.query_selector(btn):
-                                    frame.click(btn)
-                                    page.wait_for_load_state('networkidle', timeout=15000)
-                                    logged_in = True
-                                    break
-                            except Exception:
-                                continue
-                        if logged_in:
-                            break
-                    except Exception:
-                        continue
-            except Exception:
-                pass
+async def run_scrape_async(max_items=200):
+    db = DB.get(DB_PATH)
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        context = await browser.new_context()
+        await context.route('**/*', block_unneeded_requests)
+        page = await context.new_page()
 
-        if not logged_in:
-            print('Login attempt failed with available strategies; adapt selectors or check the page structure')
+        # Login flow based on recording
+        await page.goto('https://aca-prod.accela.com/DENVER/Login.aspx')
+        if not await login(page):
+            print('Login form not found or submit failed; adapt LOGIN_* selectors or check the page structure')
 
         # Navigate to development permit search
-        page.goto('https://aca-prod.accela.com/DENVER/Cap/CapHome.aspx?module=Development')
+        await page.goto('https://aca-prod.accela.com/DENVER/Cap/CapHome.aspx?module=Development')
 
         # Fill general search with %demo% (wildcard) and click search
         try:
-            page.fill('#ctl00_PlaceHolderMain_generalSearchForm_txtGSPermitNumber', '%demo%')
-            page.click('#ctl00_PlaceHolderMain_btnNewSearch')
-            page.wait_for_load_state('networkidle', timeout=15000)
+            await page.fill('#ctl00_PlaceHolderMain_generalSearchForm_txtGSPermitNumber', '%demo%')
+            await page.click('#ctl00_PlaceHolderMain_btnNewSearch')
+            await page.wait_for_load_state('domcontentloaded', timeout=15000)
         except Exception:
             print('Search controls not found; please verify selectors')
+        try:
+            # the results grid is the only thing the next step needs
+            await page.wait_for_selector(RESULTS_GRID, timeout=15000)
+        except Exception:
+            pass
 
         # Collect result permit links across paginated results
         permits = []
@@ -168,34 +200,39 @@ def run_scrape(max_items=200):
         max_pages = 25
         for page_idx in range(max_pages):
             # try known table selector first
-            rows = page.query_selector_all('#ctl00_PlaceHolderMain_dgvPermitList_gdvPermitList td a') or page.query_selector_all('a')
+            # one CDP call per selector returns every anchor's text/href, instead of two calls per anchor
+            try:
+                rows = await page.eval_on_selector_all(f'{RESULTS_GRID} td a', _ANCHORS_JS) or await page.eval_on_selector_all('a', _ANCHORS_JS)
+            except Exception:
+                rows = []
             for a in rows:
-                try:
-                    text = a.inner_text().strip()
-                    href = a.get_attribute('href')
-                    # Only add real URLs, skip javascript: and empty hrefs
-                    if not href or href.strip().lower().startswith('javascript:'):
-                        continue
-                    if text and href and href not in seen_hrefs:
-                        seen_hrefs.add(href)
-                        permits.append({'text': text, 'href': href})
-                except Exception:
+                text = (a.get('text') or '').strip()
+                href = a.get('href')
+                # Only add real URLs, skip javascript: and empty hrefs
+                if not href or href.strip().lower().startswith('javascript:'):
                     continue
+                if text and href and href not in seen_hrefs:
+                    seen_hrefs.add(href)
+                    permits.append({'text': text, 'href': href})
 
             # attempt to navigate to next page - several possible selectors
             next_clicked = False
             for sel in ['a[aria-label="Next"]', 'a:has-text("Next")', 'a:has-text("next")', 'a[title="Next"]', 'a.pager-next', 'text="Next"']:
                 try:
-                    btn = page.query_selector(sel)
+                    btn = await page.query_selector(sel)
                     if btn:
                         # check if disabled via class or aria-disabled
-                        disabled = btn.get_attribute('aria-disabled') or btn.get_attribute('class')
+                        disabled = await btn.get_attribute('aria-disabled') or await btn.get_attribute('class')
                         if disabled and ('disabled' in (disabled or '').lower() or disabled == 'true'):
                             next_clicked = False
                             continue
-                        btn.click()
-                        page.wait_for_load_state('networkidle', timeout=10000)
-                        time.sleep(1)
+                        first_row = await page.evaluate(_FIRST_ROW_TEXT_JS, f'{RESULTS_GRID} td a')
+                        await btn.click()
+                        try:
+                            # the pager posts back in place; the new page is ready once the first row changes
+                            await page.wait_for_function(_ROW_CHANGED_JS, arg=[f'{RESULTS_GRID} td a', first_row], timeout=10000)
+                        except Exception:
+                            pass
                         next_clicked = True
                         break
                 except Exception:
@@ -206,69 +243,111 @@ def run_scrape(max_items=200):
 
         print(f'Found {len(permits)} permit links (will visit up to {max_items})')
 
+        # relative hrefs are resolved against the results page they came from
+        base_url = page.url or 'https://aca-prod.accela.com'
+
+        # pool of browser pages shared by the detail workers; taking one from the queue bounds concurrency
+        pages = asyncio.Queue()
+        await pages.put(page)
+        for _ in range(max(1, SCRAPE_CONCURRENCY) - 1):
+            await pages.put(await context.new_page())
+
+        thumbs_dir = DATA_DIR / 'thumbs'
+        thumbs_dir.mkdir(parents=True, exist_ok=True)
+
+        # scraped rows flow to a single writer so DB access stays on one coroutine and is batched
+        results = asyncio.Queue()
         count = 0
-        for item in permits:
-            if count >= max_items:
-                break
+
+        async def write_results():
+            pending = []
+            while True:
+                row = await results.get()
+                if row is None:
+                    break
+                pending.append(row)
+                if len(pending) >= UPSERT_BATCH_SIZE:
+                    db.upsert_permits_many(pending)
+                    pending = []
+            db.upsert_permits_many(pending)
+
+        async def scrape_one(item):
+            nonlocal count
             try:
                 # Normalize relative hrefs to absolute URLs before navigating.
                 href = item.get('href') or ''
                 if href and not href.lower().startswith('http'):
                     try:
-                        from urllib.parse import urljoin
-                        href = urljoin(page.url or 'https://aca-prod.accela.com', href)
+                        href = urljoin(base_url, href)
                     except Exception:
                         href = 'https://aca-prod.accela.com' + href if href.startswith('/') else 'https://aca-prod.accela.com/' + href
-                page.goto(href)
-                page.wait_for_load_state('networkidle', timeout=10000)
-                data = parse_permit_detail(page)
+
+                # hold a browser page only while loading and parsing; geocoding and thumbnails run after it's returned
+                detail_page = await pages.get()
+                try:
+                    await detail_page.goto(href)
+                    # DOM is enough for extraction; networkidle would wait out analytics and map tiles
+                    await detail_page.wait_for_load_state('domcontentloaded', timeout=10000)
+                    try:
+                        await detail_page.wait_for_selector(DETAIL_READY, timeout=10000)
+                    except Exception:
+                        # field missing on this layout; parse whatever rendered
+                        pass
+                    data = await parse_permit_detail(detail_page)
+                finally:
+                    pages.put_nowait(detail_page)
+
+                lat = lon = None
+                # many ePermits include a map iframe with lat/lon in a href or script; naive search in the
+                # HTML that parse_permit_detail already pulled back (no second page.content() transfer)
+                html = data.pop('_html', None) or ''
+                m = _LATLON_RE.search(html)
+                if m:
+                    lat = float(m.group(1))
+                    lon = float(m.group(2))
+
                 permit_number = data.get('permit_number') or item['text']
                 address = data.get('address')
-                lat = lon = None
-                # Try to find lat/lon on the page
-                try:
-                    # many ePermits include a map iframe with lat/lon in a href or script; naive search in page text
-                    body = page.content()
-                    import re
-                    m = re.search(r'([-+]?[0-9]{1,3}\.[0-9]{4,}),\s*([-+]?[0-9]{1,3}\.[0-9]{4,})', body)
-                    if m:
-                        lat = float(m.group(1))
-                        lon = float(m.group(2))
-                except Exception:
-                    pass
 
                 if (not lat or not lon) and address:
-                    lat, lon = geocode_address(address)
-                    time.sleep(1)  # be polite to geocoder
+                    lat, lon = await geocode_cached(db, address)
 
                 scraped_at = datetime.utcnow().isoformat()
 
                 # fetch thumbnail (Street View preferred, satellite fallback)
                 thumb_path = None
                 if lat and lon:
-                    fname = DATA_DIR / 'thumbs' / f'{permit_number.replace("/","_")}.jpg'
-                    DATA_DIR.joinpath('thumbs').mkdir(parents=True, exist_ok=True)
+                    fname = thumbs_dir / f'{permit_number.replace("/","_")}.jpg'
                     try:
-                        thumb = fetch_streetview_thumbnail(lat, lon, fname)
+                        thumb = await fetch_streetview_thumbnail_async(lat, lon, fname)
                         if thumb:
                             thumb_path = thumb
                     except Exception:
                         # last resort: try satellite directly
                         try:
-                            thumb = fetch_satellite_thumbnail(lat, lon, fname)
+                            thumb = await fetch_satellite_thumbnail_async(lat, lon, fname)
                             if thumb:
                                 thumb_path = thumb
                         except Exception:
                             thumb_path = None
 
-                db.upsert_permit(permit_number, address, lat, lon, data, scraped_at, thumb_path)
+                await results.put((permit_number, address, lat, lon, data, scraped_at, thumb_path))
                 count += 1
                 print(f'Scraped {permit_number} ({count})')
             except Exception as e:
                 print('Error scraping item', item, e)
 
-        db.close()
-        browser.close()
+        writer = asyncio.create_task(write_results())
+        await asyncio.gather(*[scrape_one(item) for item in permits[:max_items]])
+        await results.put(None)
+        await writer
+
+        await close_async_client()
+        await browser.close()
+
+
+def run_scrape(max_items=200):
+    asyncio.run(run_scrape_async(max_items=max_items))
 
 
 if __name__ == '__main__':
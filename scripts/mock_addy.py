@@ -2,14 +2,18 @@
 """
 Simple mock Addy HTTP server for local testing.
 POST /v1/messages expects JSON {from,to,subject,html}
-It writes the payload to data/addy_mock.json and returns 200.
+It appends each payload as one JSON line to data/addy_mock.jsonl and returns 200.
+Requests are handled on their own threads, so concurrent clients don't block each other.
 """
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
 
 DATA_DIR = Path('data')
 DATA_DIR.mkdir(exist_ok=True)
+LOG_PATH = DATA_DIR / 'addy_mock.jsonl'
+_log_lock = threading.Lock()
 
 class Handler(BaseHTTPRequestHandler):
     def do_POST(self):
@@ -20,7 +24,10 @@ class Handler(BaseHTTPRequestHandler):
                 payload = json.loads(body.decode('utf8'))
             except Exception:
                 payload = {'raw': body.decode('utf8', errors='replace')}
-            (DATA_DIR / 'addy_mock.json').write_text(json.dumps({'path': self.path, 'headers': dict(self.headers), 'payload': payload}, indent=2), encoding='utf8')
+            line = json.dumps({'path': self.path, 'headers': dict(self.headers), 'payload': payload}, separators=(',', ':')).encode('utf8') + b'\n'
+            # append-only, one record per line; the lock keeps lines from interleaving across handler threads
+            with _log_lock, open(LOG_PATH, 'ab') as fh:
+                fh.write(line)
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
@@ -30,7 +37,7 @@ class Handler(BaseHTTPRequestHandler):
             self.end_headers()
 
 if __name__ == '__main__':
-    server = HTTPServer(('127.0.0.1', 8025), Handler)
+    server = ThreadingHTTPServer(('127.0.0.1', 8025), Handler)
     print('Mock Addy server running on http://127.0.0.1:8025')
     try:
         server.serve_forever()
@@ -1,5 +1,6 @@
 import os
 import sys
+import sqlite3
 import tempfile
 from pathlib import Path
 
@@ -8,28 +9,178 @@ PROJECT_ROOT = str(Path(__file__).resolve().parents[1])
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from db import DB
+from db import DB, loads_details
 
 
 def test_db_upsert_and_query():
+    db = DB(':memory:')
+    db.upsert_permit('TEST-1', '1 Main St', 39.0, -104.0, {'a': 1}, '2025-11-13T00:00:00', None)
+    rows = db.get_recent(10)
+    assert len(rows) == 1
+    assert rows[0]['permit_number'] == 'TEST-1'
+    db.upsert_permit('TEST-1', '1 Main St', 39.0, -104.0, {'a': 2}, '2025-11-14T00:00:00', None)
+    rows = db.get_recent(10)
+    assert len(rows) == 1
+    assert '2025-11-14' in rows[0]['scraped_at']
+    assert loads_details(rows[0]['details_json'], rows[0]['details_codec']) == {'a': 2}
+
+
+def test_db_upsert_permits_many():
     fd, path = tempfile.mkstemp(suffix='.db')
     os.close(fd)
     try:
         db = DB(path)
-        db.upsert_permit('TEST-1', '1 Main St', 39.0, -104.0, {'a': 1}, '2025-11-13T00:00:00', None)
-        rows = db.get_recent(10)
-        assert len(rows) == 1
-        assert rows[0]['permit_number'] == 'TEST-1'
-        db.upsert_permit('TEST-1', '1 Main St', 39.0, -104.0, {'a': 2}, '2025-11-14T00:00:00', None)
+        db.upsert_permits_many([
+            ('TEST-1', '1 Main St', 39.0, -104.0, {'a': 1}, '2025-11-13T00:00:00', None),
+            ('TEST-2', '2 Main St', 39.1, -104.1, {'a': 2}, '2025-11-13T01:00:00', None),
+            ('TEST-1', '1 Main St', 39.0, -104.0, {'a': 3}, '2025-11-14T00:00:00', 'thumbs/TEST-1.jpg'),
+        ])
+        db.close()
+        # rows must be committed to disk and visible from a fresh connection
+        db = DB(path)
         rows = db.get_recent(10)
-        assert len(rows) == 1
-        assert '2025-11-14' in rows[0]['scraped_at']
+        assert [r['permit_number'] for r in rows] == ['TEST-1', 'TEST-2']
+        assert rows[0]['thumbnail_path'] == 'thumbs/TEST-1.jpg'
+        db.close()
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def test_db_upsert_many_joins_open_transaction():
+    db = DB(':memory:')
+    try:
+        with db:
+            db.upsert_permit('A', None, None, None, {}, '2025-11-13T00:00:00', None)
+            db.upsert_permits_many([('B', None, None, None, {}, '2025-11-13T01:00:00', None)])
+            db.upsert_thumbnails_many([('A', 'thumbs/A.jpg')])
+            raise ValueError('boom')
+    except ValueError:
+        pass
+    # the batch joined the with-block's transaction, so the error rolled back all of it
+    assert db.get_recent(10) == []
+    with db:
+        db.upsert_permit('A', None, None, None, {}, '2025-11-13T00:00:00', None)
+        db.upsert_permits_many([('B', None, None, None, {}, '2025-11-13T01:00:00', None)])
+    assert [r['permit_number'] for r in db.get_recent(10)] == ['B', 'A']
+    db.close()
+
+
+def test_db_upsert_thumbnails_many():
+    db = DB(':memory:')
+    db.upsert_permits_many([
+        ('TEST-1', '1 Main St', 39.0, -104.0, {'a': 1}, '2025-11-13T00:00:00', None),
+        ('TEST-2', '2 Main St', 39.1, -104.1, {'a': 2}, '2025-11-13T01:00:00', None),
+    ])
+    db.upsert_thumbnails_many([('TEST-1', 'thumbs/TEST-1.jpg'), ('MISSING', 'thumbs/MISSING.jpg')])
+    rows = {r['permit_number']: r for r in db.get_recent(10)}
+    assert len(rows) == 2
+    assert rows['TEST-1']['thumbnail_path'] == 'thumbs/TEST-1.jpg'
+    assert loads_details(rows['TEST-1']['details_json'], rows['TEST-1']['details_codec']) == {'a': 1}
+    assert rows['TEST-2']['thumbnail_path'] is None
+    db.close()
+
+
+def test_db_get_since_filters_by_day():
+    db = DB(':memory:')
+    with db:
+        db.upsert_permit('EARLY', None, None, None, {}, '2025-11-12T23:59:59.999999', None)
+        db.upsert_permit('START', None, None, None, {}, '2025-11-13T00:00:00', None)
+        db.upsert_permit('END', None, None, None, {}, '2025-11-13T23:59:59.999999', None)
+        db.upsert_permit('LATE', None, None, None, {}, '2025-11-14T00:00:00', None)
+    rows = db.get_since('2025-11-13T08:30:00.123456')
+    assert [r['permit_number'] for r in rows] == ['START', 'END']
+    plan = db.conn.execute(
+        'EXPLAIN QUERY PLAN SELECT permit_number FROM permits WHERE scraped_at >= ? AND scraped_at < ?',
+        ('2025-11-13', '2025-11-14')
+    ).fetchall()
+    assert any('idx_permits_scraped_at' in row[-1] for row in plan)
+    db.close()
+
+
+def test_db_geocode_cache():
+    db = DB(':memory:')
+    assert db.get_cached_geocode('1 Main St') is None
+    db.put_cached_geocode('1 Main St', 39.0, -104.0)
+    db.put_cached_geocode('1 Main St', 39.5, -104.5, 'nominatim.openstreetmap.org')
+    assert db.get_cached_geocode('1 Main St') == (39.5, -104.5)
+    db.close()
+
+
+def test_db_migrates_old_geocode_cache():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE geocode_cache (address TEXT PRIMARY KEY, lat REAL, lon REAL, ts TEXT)')
+        conn.execute("INSERT INTO geocode_cache VALUES ('1 main st', 39.0, -104.0, '2025-11-13T00:00:00')")
+        conn.commit()
+        conn.close()
+        db = DB(path)
+        assert db.get_cached_geocode('1 main st') == (39.0, -104.0)
+        db.put_cached_geocode('2 main st', 39.1, -104.1, 'nominatim.openstreetmap.org')
+        assert db.get_cached_geocode('2 main st') == (39.1, -104.1)
+        db.close()
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def test_db_migrates_old_permits_details():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE permits (id INTEGER PRIMARY KEY AUTOINCREMENT, permit_number TEXT UNIQUE, address TEXT, lat REAL, lon REAL, details_json TEXT, thumbnail_path TEXT, scraped_at TEXT)')
+        conn.execute("""INSERT INTO permits (permit_number, details_json, scraped_at) VALUES ('OLD-1', '{"a": 1}', '2025-11-13T00:00:00')""")
+        conn.commit()
+        conn.close()
+        db = DB(path)
+        db.upsert_permit('NEW-1', None, None, None, {'raw_text': 'x' * 10000}, '2025-11-13T01:00:00')
+        db.commit()
+        rows = {r['permit_number']: r for r in db.get_since('2025-11-13')}
+        # rows written before details_codec existed read back as plain JSON
+        assert rows['OLD-1']['details_codec'] is None
+        assert loads_details(rows['OLD-1']['details_json'], rows['OLD-1']['details_codec']) == {'a': 1}
+        assert rows['NEW-1']['details_codec'] in ('json', 'zstd')
+        assert loads_details(rows['NEW-1']['details_json'], rows['NEW-1']['details_codec']) == {'raw_text': 'x' * 10000}
+        db.close()
     finally:
         try:
             os.remove(path)
         except Exception:
             pass
 
+
+def test_db_get_shares_connection():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        db = DB.get(path)
+        assert DB.get(path) is db
+        db.close()
+        # closing evicts the shared instance so the next get() reopens
+        assert DB.get(path) is not db
+        DB.get(path).close()
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
 if __name__ == '__main__':
     test_db_upsert_and_query()
+    test_db_upsert_permits_many()
+    test_db_upsert_many_joins_open_transaction()
+    test_db_upsert_thumbnails_many()
+    test_db_get_since_filters_by_day()
+    test_db_geocode_cache()
+    test_db_migrates_old_geocode_cache()
+    test_db_migrates_old_permits_details()
+    test_db_get_shares_connection()
     print('db test passed')
@@ -0,0 +1,103 @@
+import sys
+import asyncio
+from pathlib import Path
+
+# ensure project root is on sys.path so imports like `import utils` work when running tests directly
+PROJECT_ROOT = str(Path(__file__).resolve().parents[1])
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from utils import async_retry_backoff, is_retryable_error, retry_backoff
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class _HTTPError(Exception):
+    # shaped like requests.HTTPError / httpx.HTTPStatusError
+    def __init__(self, status_code):
+        super().__init__(f'HTTP {status_code}')
+        self.response = _Response(status_code)
+
+
+def test_is_retryable_error():
+    assert not is_retryable_error(_HTTPError(400))
+    assert not is_retryable_error(_HTTPError(404))
+    assert is_retryable_error(_HTTPError(429))
+    assert is_retryable_error(_HTTPError(503))
+    # no response attached (timeouts, connection errors): retry
+    assert is_retryable_error(ConnectionError('reset'))
+
+
+def test_retry_backoff_retry_on():
+    calls = []
+
+    @retry_backoff(max_attempts=3, initial_delay=0, retry_on=is_retryable_error)
+    def fail(status):
+        calls.append(status)
+        raise _HTTPError(status)
+
+    for status, expected_calls in ((404, 1), (503, 3)):
+        calls.clear()
+        try:
+            fail(status)
+        except _HTTPError:
+            pass
+        else:
+            raise AssertionError('expected _HTTPError')
+        assert len(calls) == expected_calls
+
+
+def test_async_retry_backoff_jitter():
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    calls = []
+
+    @async_retry_backoff(max_attempts=4, initial_delay=1.0, factor=2.0, retry_on=is_retryable_error)
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _HTTPError(429)
+        return 'ok'
+
+    asyncio.sleep = fake_sleep
+    try:
+        assert asyncio.run(flaky()) == 'ok'
+    finally:
+        asyncio.sleep = real_sleep
+    assert len(calls) == 3
+    # each delay is the exponential step scaled by a 0.5-1.5 jitter factor
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 1.5
+    assert 1.0 <= sleeps[1] <= 3.0
+
+
+def test_async_retry_backoff_non_retryable():
+    calls = []
+
+    @async_retry_backoff(max_attempts=4, initial_delay=0, retry_on=is_retryable_error)
+    async def not_found():
+        calls.append(1)
+        raise _HTTPError(404)
+
+    try:
+        asyncio.run(not_found())
+    except _HTTPError:
+        pass
+    else:
+        raise AssertionError('expected _HTTPError')
+    assert len(calls) == 1
+
+
+if __name__ == '__main__':
+    test_is_retryable_error()
+    test_retry_backoff_retry_on()
+    test_async_retry_backoff_jitter()
+    test_async_retry_backoff_non_retryable()
+    print('utils test passed')
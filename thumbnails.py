@@ -4,18 +4,21 @@ thumbnails.py
 Generate thumbnails for the N most recent permits in the DB.
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from db import DB
-from geo_imagery import fetch_streetview_thumbnail, fetch_satellite_thumbnail
+from geo_imagery import fetch_streetview_thumbnail
 
 DATA_DIR = Path(os.getenv('DATA_DIR', './data'))
 DB_PATH = DATA_DIR / 'epermits.db'
+# thumbnails are independent HTTP fetches + disk writes, so they run on a small thread pool
+THUMBNAIL_WORKERS = 8
 
 
 def generate_recent_thumbnails(limit: int = 30, size=(400, 300)):
-    db = DB(DB_PATH)
+    db = DB.get(DB_PATH)
     rows = db.get_recent(limit)
-    generated = []
+    todo = []
     for r in rows:
         permit = r['permit_number']
         lat = r['lat']
@@ -25,14 +28,24 @@ def generate_recent_thumbnails(limit: int = 30, size=(400, 300)):
             continue
         if thumb and Path(thumb).exists():
             continue
+        todo.append((permit, lat, lon))
+
+    def fetch_one(job):
+        permit, lat, lon = job
         fname = DATA_DIR / 'thumbs' / f"{permit.replace('/', '_')}.jpg"
-        # try streetview first (may fallback internally)
-        out = fetch_streetview_thumbnail(lat, lon, fname, size=size)
-        if out:
-            db.upsert_permit(permit, r['address'], lat, lon, r['details_json'] and r['details_json'], r['scraped_at'], str(out))
-            generated.append(str(out))
-    db.close()
-    return generated
+        try:
+            # try streetview first (may fallback internally)
+            out = fetch_streetview_thumbnail(lat, lon, fname, size=size)
+        except Exception as e:
+            print('Thumbnail failed for', permit, e)
+            out = None
+        return permit, str(out) if out else None
+
+    # the DB is only touched from this thread: fetch in parallel, then record all paths in one transaction
+    with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as pool:
+        results = [(permit, out) for permit, out in pool.map(fetch_one, todo) if out]
+    db.upsert_thumbnails_many(results)
+    return [out for _, out in results]
 
 
 if __name__ == '__main__':
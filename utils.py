@@ -1,28 +1,127 @@
 """
 utils.py
 
-Helpers: resilient requests session and a retry decorator with exponential backoff.
+Helpers: one-time .env loading, resilient requests session, a shared async HTTP client, retry decorators
+(sync and async) with exponential backoff and small filesystem helpers.
 """
+import os
 import time
+import random
+import shutil
+import asyncio
+import functools
 import logging
+import weakref
+from pathlib import Path
 from typing import Callable
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 
-def get_requests_session(retries: int = 3, backoff_factor: float = 0.5, status_forcelist=(500, 502, 503, 504)) -> requests.Session:
+_ENV_LOADED = False
+
+
+def load_env_once():
+    """
+    Load `.env` into os.environ the first time it's called; later calls are no-ops.
+    Modules that read settings at import time call this instead of load_dotenv() so a run that
+    imports several of them only locates and parses the file once.
+    """
+    global _ENV_LOADED
+    if _ENV_LOADED:
+        return
+    from dotenv import load_dotenv
+    load_dotenv()
+    _ENV_LOADED = True
+
+
+def get_requests_session(retries: int = 3, backoff_factor: float = 0.5, status_forcelist=(500, 502, 503, 504), pool_size: int = 32) -> requests.Session:
     sess = requests.Session()
     retry = Retry(total=retries, read=retries, connect=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist, raise_on_status=False)
-    adapter = HTTPAdapter(max_retries=retry)
+    # pool_size bounds keep-alive connections per host; keep it >= the number of concurrent requests
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
     sess.mount('http://', adapter)
     sess.mount('https://', adapter)
     sess.headers.update({'User-Agent': 'epermits-scraper/1.0'})
     return sess
 
 
-def retry_backoff(max_attempts: int = 4, initial_delay: float = 0.5, factor: float = 2.0, exceptions=(Exception,)) -> Callable:
+# one httpx.AsyncClient per event loop: its connection pool is bound to the loop that created it
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Return the shared `httpx.AsyncClient` for the running event loop, creating it on first use.
+    HTTP/2 is used when the server supports it, so concurrent requests to one host share a connection.
+    """
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            timeout=20,
+            headers={'User-Agent': 'epermits-scraper/1.0'},
+        )
+        _ASYNC_CLIENTS[loop] = client
+    return client
+
+
+async def close_async_client():
+    client = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class AsyncRateLimiter:
+    """
+    Spaces calls to `wait()` at least `interval` seconds apart across all coroutines of an event loop
+    (e.g. Nominatim's 1 request/second policy), without blocking the loop while waiting.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = None
+        self._loop = None
+        self._last = None
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio.Lock binds to one loop; start fresh for each asyncio.run()
+            self._lock = asyncio.Lock()
+            self._loop = loop
+            self._last = None
+        async with self._lock:
+            if self._last is not None:
+                delay = self._last + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._last = loop.time()
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    `retry_on` predicate: HTTP 4xx responses (other than 429 Too Many Requests) won't succeed on a retry.
+    Works for requests.HTTPError and httpx.HTTPStatusError, which both carry `.response.status_code`.
+    """
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    if status is not None and 400 <= status < 500 and status != 429:
+        return False
+    return True
+
+
+def retry_backoff(max_attempts: int = 4, initial_delay: float = 0.5, factor: float = 2.0, exceptions=(Exception,), retry_on: Callable | None = None) -> Callable:
+    """
+    Retry `fn` on `exceptions` with exponential backoff. `retry_on(exc)` returning False re-raises at once.
+    Blocks the calling thread while waiting; use `async_retry_backoff` for coroutines.
+    """
     def decorator(fn: Callable):
+        @functools.wraps(fn)
         def wrapper(*args, **kwargs):
             attempt = 0
             delay = initial_delay
@@ -31,6 +130,8 @@ def retry_backoff(max_attempts: int = 4, initial_delay: float = 0.5, factor: flo
                     return fn(*args, **kwargs)
                 except exceptions as e:
                     attempt += 1
+                    if retry_on is not None and not retry_on(e):
+                        raise
                     if attempt >= max_attempts:
                         logging.exception('Max retry attempts reached for %s', fn.__name__)
                         raise
@@ -39,3 +140,67 @@ def retry_backoff(max_attempts: int = 4, initial_delay: float = 0.5, factor: flo
                     delay *= factor
         return wrapper
     return decorator
+
+
+def async_retry_backoff(max_attempts: int = 4, initial_delay: float = 0.5, factor: float = 2.0, exceptions=(Exception,), retry_on: Callable | None = None) -> Callable:
+    """
+    Coroutine version of `retry_backoff`: waits with asyncio.sleep so the event loop keeps running, and
+    jitters each delay (x0.5-1.5) so concurrent callers that failed together don't retry in lockstep.
+    """
+    def decorator(fn: Callable):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            attempt = 0
+            delay = initial_delay
+            while True:
+                try:
+                    return await fn(*args, **kwargs)
+                except exceptions as e:
+                    attempt += 1
+                    if retry_on is not None and not retry_on(e):
+                        raise
+                    if attempt >= max_attempts:
+                        logging.exception('Max retry attempts reached for %s', fn.__name__)
+                        raise
+                    sleep_for = delay * random.uniform(0.5, 1.5)
+                    logging.warning('Error in %s: %s. Retrying in %.1fs (attempt %d/%d)', fn.__name__, e, sleep_for, attempt, max_attempts)
+                    await asyncio.sleep(sleep_for)
+                    delay *= factor
+        return wrapper
+    return decorator
+
+
+def link_or_copy(src, dst) -> Path:
+    """
+    Make `dst` refer to the same bytes as `src`: a hardlink when both are on one filesystem,
+    otherwise a regular copy. An existing `dst` is replaced.
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.exists():
+        if os.path.samefile(src, dst):
+            return dst
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        # cross-device (EXDEV) or no hardlink support; copyfile uses sendfile where available
+        shutil.copyfile(src, dst)
+    return dst
+
+
+IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif'})
+
+
+def list_image_assets(assets_dir) -> list:
+    """
+    Return `os.DirEntry` objects for the image files directly inside `assets_dir` ([] if it doesn't exist).
+    scandir's cached d_type answers is_file() without a stat per entry.
+    """
+    try:
+        with os.scandir(assets_dir) as it:
+            return [
+                e for e in it
+                if e.is_file(follow_symlinks=False) and e.name.rpartition('.')[2].lower() in IMAGE_EXTENSIONS
+            ]
+    except FileNotFoundError:
+        return []